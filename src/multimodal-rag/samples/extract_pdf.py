@@ -6,23 +6,31 @@ This module provides functionality to extract text from PDF files using differen
 It allows comparing the performance and results of each library.
 
 Usage:
-    python pdf_extractor.py <file_path> [--extractors=<extractors>] [--output_dir=<output_dir>]
+    python pdf_extractor.py <file_path> [--extractors=<extractors>] [--output_dir=<output_dir>] [--layout] [--no-cache]
 
 Options:
     --extractors=<extractors>   Comma-separated list of extractors to use (default: all)
     --output_dir=<output_dir>   Directory to save the extracted text files (default: current directory)
+    --layout                    Preserve the page layout in PDFPlumber output (slower)
+    --no-cache                  Always run the extractors instead of reading the page cache (use this to compare timings)
 
 """
 
 import os
+import errno
+import hashlib
+import shutil
+import tempfile
 import time
+import functools
+from importlib import metadata
 import argparse
-import PyPDF2
-import pdfplumber
-from pdf2image import convert_from_path
-from pydantic import BaseModel
+from concurrent.futures import ProcessPoolExecutor, as_completed
 # import textract
 
+HASH_CHUNK_SIZE = 1 << 20
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "multimodal-rag")
+
 def measure_time(func):
     """
     Decorator to measure the execution time of a function.
@@ -32,11 +40,11 @@ def measure_time(func):
     :return: The wrapped function.
     :rtype: function
     """
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = time.time()
+        start_time = time.perf_counter_ns()
         result = func(*args, **kwargs)
-        end_time = time.time()
-        execution_time = end_time - start_time
+        execution_time = (time.perf_counter_ns() - start_time) / 1e9
         return result, execution_time
     return wrapper
 
@@ -60,32 +68,148 @@ def save_sections_to_dirs(file_path, sections, output_dir, save_func, process_na
     
     for i, section in enumerate(sections, start=1):
         section_dir = os.path.join(parent_dir, str(i))
-        os.makedirs(section_dir, exist_ok=True)
+        # parent_dirは作成済みなので、中間ディレクトリを辿るmakedirsではなくmkdirで作成する
+        try:
+            os.mkdir(section_dir)
+        except FileExistsError:
+            pass
         section_file = os.path.join(section_dir, f"section_{i}_{process_name}")
         save_func(section, section_file)
         
+def hash_file(file_path):
+    """
+    Computes the BLAKE2b digest of a file's content, reading it in chunks.
+
+    :param file_path: The path to the file.
+    :type file_path: str
+    :return: The hex digest of the file content.
+    :rtype: str
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 class PDFExtractor:
     """
     Base class for PDF text extractors.
 
+    Extracted pages are cached under CACHE_DIR keyed by the PDF content hash, the extractor and
+    the version of its library, so re-running on the same PDF skips the parser.
+
     :param file_path: The path to the PDF file.
     :type file_path: str
     :param output_dir: The directory to save the extracted text files.
     :type output_dir: str
+    :param use_cache: Whether to read and write the page cache.
+    :type use_cache: bool
     """
-    def __init__(self, file_path, output_dir):
+    # 抽出に使うライブラリのディストリビューション名 (キャッシュキーにバージョンを含めるために使う)
+    library = None
+
+    def __init__(self, file_path, output_dir, use_cache=True):
         self.file_path = file_path
         self.output_dir = output_dir
+        self.use_cache = use_cache
+        self.from_cache = False
+
+    @property
+    def cache_key(self):
+        """
+        The name of the per-extractor cache directory. It includes the library version so that
+        upgrading the library invalidates the cache. Subclasses with options that change the output
+        should include them here.
+
+        :rtype: str
+        """
+        return f"{self.__class__.__name__}_{metadata.version(self.library)}"
+
+    def extract_text(self) -> tuple[list[str], float]:
+        """
+        Extracts text from the PDF file, using the page cache when enabled, and saves the sections.
+        Hashing the PDF for the cache key is not included in the execution time. Whether the result
+        came from the cache is available as from_cache afterwards.
 
-    def extract_text(self) -> list[str]:
+        :return: The extracted text sections and the execution time.
+        :rtype: tuple (list of str, float)
+        """
+        cache_dir = os.path.join(CACHE_DIR, hash_file(self.file_path), self.cache_key) if self.use_cache else None
+        return self._extract_text(cache_dir)
+
+    @measure_time
+    def _extract_text(self, cache_dir):
         """
-        Extracts text from the PDF file.
+        Loads the sections from the cache or extracts them with extract_pages, then saves them.
+        This is the timed part of extract_text.
 
+        :param cache_dir: The cache directory for this PDF and extractor, or None to bypass the cache.
+        :type cache_dir: str or None
         :return: The extracted text sections and the execution time.
-        :rtype: list of sections (str)
+        :rtype: tuple (list of str, float)
+        """
+        sections = self.load_cached_sections(cache_dir) if cache_dir is not None else None
+        self.from_cache = sections is not None
+        if sections is None:
+            sections = self.extract_pages()
+            if cache_dir is not None:
+                self.cache_sections(cache_dir, sections)
+        self.save_sections(sections)
+        return sections
+
+    def extract_pages(self) -> list[str]:
+        """
+        Extracts the text of every page with the underlying library.
+
+        :return: The extracted text sections, one per page.
+        :rtype: list of str
         :raises NotImplementedError: If the subclass does not implement this method.
         """
-        raise NotImplementedError("Subclass must implement extract_text method.")
+        raise NotImplementedError("Subclass must implement extract_pages method.")
+
+    def load_cached_sections(self, cache_dir):
+        """
+        Loads the cached text sections if every page has been cached.
+
+        :param cache_dir: The cache directory for this PDF and extractor.
+        :type cache_dir: str
+        :return: The cached text sections, or None if the cache is missing or incomplete.
+        :rtype: list of str or None
+        """
+        try:
+            with open(os.path.join(cache_dir, 'page_count'), 'r', encoding='utf-8') as file:
+                page_count = int(file.read())
+            sections = []
+            for i in range(1, page_count + 1):
+                with open(os.path.join(cache_dir, f"{i}.txt"), 'rb') as file:
+                    sections.append(file.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+        return sections
+
+    def cache_sections(self, cache_dir, sections):
+        """
+        Writes the text sections to the cache. Each file is written to a temporary path and renamed
+        so concurrent or interrupted runs never leave a partial page behind; the page count is written
+        last and marks the cache as complete.
+
+        :param cache_dir: The cache directory for this PDF and extractor.
+        :type cache_dir: str
+        :param sections: The extracted text sections.
+        :type sections: list of str
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+
+        def write_atomic(file_name, data):
+            path = os.path.join(cache_dir, file_name)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+
+        for i, section in enumerate(sections, start=1):
+            write_atomic(f"{i}.txt", section.encode('utf-8'))
+        write_atomic('page_count', str(len(sections)).encode('utf-8'))
 
     def save_sections(self, sections):
         """
@@ -95,8 +219,10 @@ class PDFExtractor:
         :type sections: list of str
         """
         def save_text(section, file_path):
-            with open(f"{file_path}.txt", 'w', encoding='utf-8') as file:
-                file.write(section)
+            # 一度だけエンコードし、テキストI/Oのエンコーダを経由せずにバイナリで書き込む
+            data = section.encode('utf-8')
+            with open(f"{file_path}.txt", 'wb') as file:
+                file.write(data)
 
         save_sections_to_dirs(self.file_path, sections, self.output_dir, save_text, self.__class__.__name__)
 
@@ -104,69 +230,186 @@ class PyPDF2Extractor(PDFExtractor):
     """
     PDF text extractor using PyPDF2 library.
     """
-    @measure_time
-    def extract_text(self) -> list[str]:
+    library = "PyPDF2"
+
+    def extract_pages(self) -> list[str]:
         """
         Extracts text from the PDF file using PyPDF2 library.
 
-        :return: The extracted text and the execution time.
-        :rtype: tuple (str, float)
+        :return: The extracted text sections.
+        :rtype: list of str
         """
+        import PyPDF2
+
         with open(self.file_path, 'rb') as file:
             reader = PyPDF2.PdfReader(file)
             sections = []
-            for page in range(len(reader.pages)):
-                section = reader.pages[page].extract_text()
+            for page in reader.pages:
+                section = page.extract_text() or ""
                 sections.append(section)
-        self.save_sections(sections)
         return sections
 
+def _extract_pdfplumber_range(file_path, start, stop, layout=False):
+    """
+    Extracts text from the pages in [start, stop) using pdfplumber library.
+    Each worker process opens its own document so no parser state is shared.
+
+    :param file_path: The path to the PDF file.
+    :type file_path: str
+    :param start: The index of the first page to extract.
+    :type start: int
+    :param stop: The index after the last page to extract.
+    :type stop: int
+    :param layout: Whether to run pdfplumber's layout-preserving text extraction.
+    :type layout: bool
+    :return: The extracted text sections in page order.
+    :rtype: list of str
+    """
+    import pdfplumber
+
+    with pdfplumber.open(file_path) as pdf:
+        return [(page.extract_text(layout=layout, x_tolerance=3, y_tolerance=3) or "") for page in pdf.pages[start:stop]]
+
 class PDFPlumberExtractor(PDFExtractor):
     """
     PDF text extractor using pdfplumber library.
+
+    By default pages are extracted in reading order without layout analysis, which is much faster;
+    the layout is reconstructed later from the page image by the OCR step anyway.
+
+    :param layout: Whether to preserve the page layout with pdfplumber's layout mode.
+    :type layout: bool
+    :param workers: The number of worker processes for page extraction (default: os.cpu_count()).
+    :type workers: int
     """
-    @measure_time
-    def extract_text(self) -> list[str]:
+    library = "pdfplumber"
+
+    def __init__(self, file_path, output_dir, use_cache=True, layout=False, workers=None):
+        super().__init__(file_path, output_dir, use_cache)
+        self.layout = layout
+        self.workers = workers or os.cpu_count() or 1
+
+    @property
+    def cache_key(self):
+        return f"{super().cache_key}_layout" if self.layout else super().cache_key
+
+    def extract_pages(self) -> list[str]:
         """
         Extracts text from the PDF file using pdfplumber library.
 
-        :return: The extracted text and the execution time.
-        :rtype: tuple (str, float)
+        :return: The extracted text sections.
+        :rtype: list of str
         """
+        import pdfplumber
+
         with pdfplumber.open(self.file_path) as pdf:
-            sections = []
-            for page in pdf.pages:
-                section = page.extract_text()
-                sections.append(section)
-        self.save_sections(sections)
-        return sections
+            page_count = len(pdf.pages)
+
+        # ページ範囲ごとにワーカープロセスへ分割して並列に抽出する
+        workers = min(self.workers, page_count)
+        if workers <= 1:
+            return _extract_pdfplumber_range(self.file_path, 0, page_count, self.layout)
+
+        chunk_size = -(-page_count // workers)
+        ranges = [(lo, min(lo + chunk_size, page_count)) for lo in range(0, page_count, chunk_size)]
+        with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(_extract_pdfplumber_range, self.file_path, lo, hi, self.layout) for lo, hi in ranges]
+            return [section for future in futures for section in future.result()]
+
+class PyMuPDFExtractor(PDFExtractor):
+    """
+    PDF text extractor using PyMuPDF (fitz) library.
+    """
+    library = "PyMuPDF"
+
+    def extract_pages(self) -> list[str]:
+        """
+        Extracts text from the PDF file using PyMuPDF library.
+
+        :return: The extracted text sections.
+        :rtype: list of str
+        """
+        import fitz
+
+        doc = fitz.open(self.file_path)
+        try:
+            return [page.get_text("text") for page in doc]
+        finally:
+            doc.close()
 
+class PyPDFium2Extractor(PDFExtractor):
+    """
+    PDF text extractor using pypdfium2 (PDFium) library.
+    """
+    library = "pypdfium2"
+
+    def extract_pages(self) -> list[str]:
+        """
+        Extracts text from the PDF file using pypdfium2 library.
+
+        :return: The extracted text sections.
+        :rtype: list of str
+        """
+        import pypdfium2 as pdfium
+
+        pdf = pdfium.PdfDocument(self.file_path)
+        try:
+            return [page.get_textpage().get_text_range() for page in pdf]
+        finally:
+            pdf.close()
 
-def convert_pdf_to_images(pdf_file_path, output_dir):
+
+def _fast_move(src, dst):
+    """
+    Moves a file, overwriting the destination. Renames it when possible and otherwise copies it with
+    shutil.copyfile, which already uses os.sendfile (Linux) or fcopyfile (macOS) with a safe fallback.
+
+    :param src: The path of the file to move.
+    :type src: str
+    :param dst: The destination path.
+    :type dst: str
+    """
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    # 別のファイルシステムへの移動はコピーしてから元のファイルを削除する
+    shutil.copyfile(src, dst)
+    os.unlink(src)
+
+def convert_pdf_to_images(pdf_file_path, output_dir, thread_count=None):
     """
     指定されたPDFファイルの各ページを画像ファイルに変換し、指定されたディレクトリに保存する。
     
     Args:
     pdf_file_path (str): PDFファイルのパス。
     output_directory (str): 生成された画像を保存するディレクトリのパス。
+    thread_count (int): ラスタライズに使うPopplerのプロセス数 (デフォルト: os.cpu_count())。
     """
-    # 出力ディレクトリが存在しない場合は作成
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    
-    # PDFファイルを画像に変換
-    images = convert_from_path(pdf_file_path)
-
-    # 各画像を指定されたディレクトリに保存
-    # for i, image in enumerate(images):
-    #     image_path = os.path.join(output_dir, f'page_{i + 1}.png')
-    #     image.save(image_path, 'PNG')
-    #     print(f'Saved: {image_path}')
-    
-    def save_image(image, file_path):
-        image.save(f"{file_path}.png", 'PNG')
+    from pdf2image import convert_from_path
+
+    # 出力ディレクトリが存在しない場合は作成 (抽出処理が並行して作成する場合があるためexist_okにする)
+    os.makedirs(output_dir, exist_ok=True)
     
-    save_sections_to_dirs(pdf_file_path, images, output_dir, save_image, "pdf2image")
+    # 移動がrenameだけで済むよう、一時ディレクトリは出力先と同じファイルシステムに作成する
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        # PDFファイルを画像に変換 (Popplerでページを並列にラスタライズし、PNGを直接書き出す)
+        image_paths = convert_from_path(pdf_file_path, thread_count=thread_count or os.cpu_count() or 1, fmt='png', output_folder=tmp_dir, paths_only=True)
+
+        # 各画像を指定されたディレクトリに保存
+        # for i, image in enumerate(images):
+        #     image_path = os.path.join(output_dir, f'page_{i + 1}.png')
+        #     image.save(image_path, 'PNG')
+        #     print(f'Saved: {image_path}')
+
+        # Popplerが書き出したPNGを再エンコードせずに移動する
+        def save_image(image_path, file_path):
+            _fast_move(image_path, f"{file_path}.png")
+
+        save_sections_to_dirs(pdf_file_path, image_paths, output_dir, save_image, "pdf2image")
         
 # class TextractExtractor(PDFExtractor):
 #     """
@@ -183,51 +426,94 @@ def convert_pdf_to_images(pdf_file_path, output_dir):
 #         text = textract.process(self.file_path).decode('utf-8')
 #         return text
 
-def main(file_path, extractors, output_dir):
+EXTRACTOR_CLASSES = {
+    'PyPDF2': PyPDF2Extractor,
+    'PDFPlumber': PDFPlumberExtractor,
+    'PyMuPDF': PyMuPDFExtractor,
+    'PyPDFium2': PyPDFium2Extractor,
+    # 'Textract': TextractExtractor
+}
+
+def _run_extractor(extractor_name, file_path, output_dir, **options):
+    """
+    Runs a single extractor. Defined at module level so it can be dispatched to a worker process.
+
+    :param extractor_name: The name of the extractor in EXTRACTOR_CLASSES.
+    :type extractor_name: str
+    :param file_path: The path to the PDF file.
+    :type file_path: str
+    :param output_dir: Directory to save the extracted text files.
+    :type output_dir: str
+    :param options: Extra keyword arguments for the extractor class.
+    :return: The extractor name, the extracted text sections, the execution time and whether the sections came from the cache.
+    :rtype: tuple (str, list of str, float, bool)
+    """
+    extractor = EXTRACTOR_CLASSES[extractor_name](file_path, output_dir, **options)
+    sections, execution_time = extractor.extract_text()
+    return extractor_name, sections, execution_time, extractor.from_cache
+
+def main(file_path, extractors, output_dir, layout=False, use_cache=True):
     """
     Main function to demonstrate the usage of PDF text extractors.
 
+    The selected extractors and the image conversion are independent of each other,
+    so they are run concurrently in separate processes.
+
     :param file_path: The path to the PDF file.
     :type file_path: str
     :param extractors: List of extractors to use.
     :type extractors: list of str
     :param output_dir: Directory to save the extracted text files.
     :type output_dir: str
+    :param layout: Whether PDFPlumber should preserve the page layout.
+    :type layout: bool
+    :param use_cache: Whether the extractors may read and write the page cache.
+    :type use_cache: bool
     """
     if extractors == ['all']:
-        extractors = ['PyPDF2', 'PDFPlumber', 'Textract']
-    
-    extractor_classes = {
-        'PyPDF2': PyPDF2Extractor,
-        'PDFPlumber': PDFPlumberExtractor,
-        # 'Textract': TextractExtractor
-    }
-    
+        extractors = ['PyPDF2', 'PDFPlumber', 'PyMuPDF', 'PyPDFium2']
+
+    extractor_names = []
     for extractor_name in extractors:
-        extractor_class = extractor_classes.get(extractor_name)
-        if extractor_class:
-            extractor = extractor_class(file_path, output_dir)
-            text, execution_time = extractor.extract_text()
+        if extractor_name in EXTRACTOR_CLASSES:
+            extractor_names.append(extractor_name)
+        else:
+            print(f"Unknown extractor: {extractor_name}")
+
+    # 内部で並列化する重いジョブ (PDFPlumberのページ抽出とPopplerのラスタライズ) でCPUを分け合う。
+    # その他の抽出処理 (PyPDF2・PyMuPDF・PyPDFium2) は内部で並列化せず1CPUずつ使うだけで、すぐに終わるため
+    # 開始直後に一時的にCPU数を超えることは許容する
+    job_count = len(extractor_names) + 1
+    cpu_count = os.cpu_count() or 1
+    heavy_job_count = 1 + ('PDFPlumber' in extractor_names)
+    cpu_budget = max(1, cpu_count // heavy_job_count)
+
+    extractor_options = {'PDFPlumber': {'layout': layout, 'workers': cpu_budget}}
+
+    max_workers = min(job_count, cpu_count)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # save image files
+        image_future = executor.submit(convert_pdf_to_images, file_path, output_dir, cpu_budget)
+        futures = [executor.submit(_run_extractor, extractor_name, file_path, output_dir, use_cache=use_cache, **extractor_options.get(extractor_name, {})) for extractor_name in extractor_names]
+
+        for future in as_completed(futures):
+            extractor_name, text, execution_time, from_cache = future.result()
             print(f"Extractor: {extractor_name}")
             print(f"Extracted Text: {text[:100]}...")
-            print(f"Execution Time: {execution_time:.2f} seconds")
+            print(f"Execution Time: {execution_time:.2f} seconds{' (from cache)' if from_cache else ''}")
             print("---")
-            
-            # output_file = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(file_path))[0]}_{extractor_name}.txt")
-            # with open(output_file, 'w', encoding='utf-8') as file:
-            #     file.write(text)
-        else:
-            print(f"Unknown extractor: {extractor_name}")
-    # save image files
-    convert_pdf_to_images(file_path, output_dir)
+
+        image_future.result()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='PDF Text Extractor')
     parser.add_argument('file_path', help='Path to the PDF file')
     parser.add_argument('--extractors', default='all', help='Comma-separated list of extractors to use (default: all)')
     parser.add_argument('--output_dir', default='.', help='Directory to save the extracted text files (default: current directory)')
+    parser.add_argument('--layout', action='store_true', help='Preserve the page layout in PDFPlumber output (slower)')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', help='Always run the extractors instead of reading the page cache (use this to compare timings)')
     
     args = parser.parse_args()
     
     extractors = args.extractors.split(',')
-    main(args.file_path, extractors, args.output_dir)
\ No newline at end of file
+    main(args.file_path, extractors, args.output_dir, args.layout, args.use_cache)
\ No newline at end of file
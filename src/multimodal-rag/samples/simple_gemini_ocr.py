@@ -1,9 +1,29 @@
 from google import generativeai
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 import os, sys
 import time
+import functools
+import json
+import hashlib
+import random
+from concurrent.futures import ThreadPoolExecutor
 from google.generativeai.types.generation_types import GenerateContentResponse
 
+# アップロード済み画像のキャッシュ (画像内容のsha256 -> アップロードファイル名)
+UPLOAD_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "gemini_uploads.json")
+# 同時に発行するgenerate_contentリクエストの上限 (APIのレート制限に合わせて調整する)
+MAX_WORKERS = 16
+# クォータ超過 (429 ResourceExhausted) 時の再試行回数と初回の待ち時間(秒)。待ち時間は再試行ごとに倍にする
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 4.0
+
+# プロンプトの固定部分 (読み取り結果以外) は一度だけ組み立てておく
+PROMPT_PREFIX = "画像ファイルはPDFを画像化したものです。このPDFの配置構造を理解し、文脈を踏まえたうえでテキストになおしてください。文字は日本語をベースに書かれています。最終的な構造はMarkdown形式にして出力してください。その後、このPDFで書かれている内容を解釈して解説してください。これを別のPDF解析ツールで読み取りした結果は以下です。\n読み取り結果: "
+
+# 全てのワーカースレッドで共有するモデル (__main__で初期化する)
+_MODEL = None
+
 def measure_time(func):
     """
     Decorator to measure the execution time of a function.
@@ -13,56 +33,118 @@ def measure_time(func):
     :return: The wrapped function.
     :rtype: function
     """
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = time.time()
+        start_time = time.perf_counter_ns()
         result = func(*args, **kwargs)
-        end_time = time.time()
-        execution_time = end_time - start_time
+        execution_time = (time.perf_counter_ns() - start_time) / 1e9
         return result, execution_time
     return wrapper
 
-def find_image_file(directory_path):
-    # ディレクトリ内のpngファイルを検索
-    for filename in os.listdir(directory_path):
-        if filename.endswith(".png"):
-            return os.path.join(directory_path, filename)
-    return None
+def list_input_files(directory_path):
+    # ディレクトリを一度だけ走査し、pngファイルとtxtファイルを振り分ける
+    with os.scandir(directory_path) as entries:
+        filenames = [entry.name for entry in entries if entry.is_file()]
+    image_path = next((os.path.join(directory_path, filename) for filename in filenames if filename.endswith(".png")), None)
+    txt_files = [filename for filename in filenames if filename.endswith(".txt")]
+    return image_path, txt_files
 
-@measure_time
-def process_files(directory_path):
-    image_path = find_image_file(directory_path)
-    if image_path is None:
-        print("Error: No PNG file found in the directory.")
-        return
+def load_upload_cache():
+    # キャッシュが無い、または壊れている場合は空のキャッシュとして扱う
+    try:
+        with open(UPLOAD_CACHE_PATH, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def save_upload_cache(cache):
+    # 書き込み途中で中断・競合してもファイルが壊れないよう、一時ファイルに書いてから置き換える
+    os.makedirs(os.path.dirname(UPLOAD_CACHE_PATH), exist_ok=True)
+    tmp_path = f"{UPLOAD_CACHE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(cache, file)
+    os.replace(tmp_path, UPLOAD_CACHE_PATH)
+
+def upload_image(image_path):
+    # 同じ内容の画像が既にアップロード済みであれば再利用する
+    with open(image_path, "rb") as file:
+        digest = hashlib.sha256(file.read()).hexdigest()
+
+    cache = load_upload_cache()
+    if digest in cache:
+        try:
+            return generativeai.get_file(cache[digest])
+        except google_exceptions.GoogleAPICallError:
+            # アップロードファイルは一定期間で削除されるため、取得できなければアップロードし直す
+            pass
 
-    # ディレクトリ内のtxtファイルを処理
-    for filename in os.listdir(directory_path):
-        if filename.endswith(".txt"):
-            file_path = os.path.join(directory_path, filename)
+    image = generativeai.upload_file(path=image_path)
+    cache[digest] = image.name
+    save_upload_cache(cache)
+    return image
 
-            # 画像ファイルをアップロード
-            image = generativeai.upload_file(path=image_path)
+def generate_with_retry(contents, consume):
+    # レスポンスを受信し終えるまでを1回の試行とし、クォータ超過の場合は待ってから再試行する
+    # (クォータは1分単位のため、指数バックオフに揺らぎを加えて各スレッドの再試行タイミングをずらす)
+    for attempt in range(MAX_RETRIES):
+        try:
+            response: GenerateContentResponse = _MODEL.generate_content(contents, stream=True)
+            return consume(response)
+        except google_exceptions.ResourceExhausted:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, 1))
 
-            # テキストファイルを読み込む
-            with open(file_path, "r") as file:
-                file_content = file.read()
+def process_text_file(directory_path, filename, image):
+    file_path = os.path.join(directory_path, filename)
 
-            prompt = f"画像ファイルはPDFを画像化したものです。このPDFの配置構造を理解し、文脈を踏まえたうえでテキストになおしてください。文字は日本語をベースに書かれています。最終的な構造はMarkdown形式にして出力してください。その後、このPDFで書かれている内容を解釈して解説してください。これを別のPDF解析ツールで読み取りした結果は以下です。\n読み取り結果: {file_content}"
+    # テキストファイルを読み込む
+    with open(file_path, "r") as file:
+        file_content = file.read()
 
-            response: GenerateContentResponse = model.generate_content([prompt, image])
+    prompt = PROMPT_PREFIX + file_content
+
+    generate_with_retry([prompt, image], lambda response: stream_markdown(file_path, response))
+    print(f"Processed: {filename}")
+
+def markdown_path(file_path):
+    return os.path.splitext(file_path)[0] + ".md"
+
+def chunk_text(chunk):
+    # chunk.textは本文の無いチャンク (終了理由だけのチャンクやSAFETY等での停止) で例外になるため、partsから取り出す
+    if not chunk.candidates:
+        return ""
+    return "".join(part.text for part in chunk.candidates[0].content.parts)
+
+def stream_markdown(file_path, response):
+    # 結果をmdファイルとして保存 (チャンクを受信するたびに追記し、途中までの結果もファイルに残す)
+    with open(markdown_path(file_path), "wb") as md_file:
+        for chunk in response:
+            text = chunk_text(chunk)
+            if not text:
+                continue
+            md_file.write(text.encode("utf-8"))
+            md_file.flush()
+
+@measure_time
+def process_files(directory_path):
+    image_path, txt_files = list_input_files(directory_path)
+    if image_path is None:
+        print("Error: No PNG file found in the directory.")
+        return
 
-            # 結果をmdファイルとして保存
-            md_file_path = os.path.splitext(file_path)[0] + ".md"
-            with open(md_file_path, "w") as md_file:
-                md_file.write(response.candidates[0].content.parts[0].text)
+    # 画像ファイルをアップロード (全てのtxtファイルで共有する)
+    image = upload_image(image_path)
 
-            print(f"Processed: {filename}")
+    # ディレクトリ内のtxtファイルを並列に処理 (APIリクエストはネットワーク待ちが支配的)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(lambda filename: process_text_file(directory_path, filename, image), txt_files))
 
 # run as main
 if __name__ == "__main__":
     load_dotenv()
     generativeai.configure(api_key=os.environ["GOOGLE_API_KEY"])
-    model = generativeai.GenerativeModel("models/gemini-1.5-pro-latest")
+    _MODEL = generativeai.GenerativeModel("models/gemini-1.5-pro-latest")
 
     # コマンドライン引数からディレクトリのパスを取得
     if len(sys.argv) < 2:
@@ -8,7 +8,7 @@ if __name__ == "__main__":
     load_dotenv()
     client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
     audio_file = open("example_data/audio.mp3", "rb")
-    start_time = time.time()
+    start_time = time.perf_counter()
     transcription = client.audio.transcriptions.create(model="whisper-1", language="ja", file=audio_file)
     print(transcription.text)
-    print(f"処理にかかった時間: {time.time()-start_time} 秒")
+    print(f"処理にかかった時間: {time.perf_counter()-start_time} 秒")
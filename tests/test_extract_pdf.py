@@ -0,0 +1,146 @@
+import errno
+import importlib.util
+import os
+from importlib import metadata
+
+import pytest
+
+MODULE_PATH = os.path.join(os.path.dirname(__file__), os.pardir, "src", "multimodal-rag", "samples", "extract_pdf.py")
+
+
+@pytest.fixture(scope="module")
+def extract_pdf():
+    spec = importlib.util.spec_from_file_location("extract_pdf", MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def cache_dir(extract_pdf, tmp_path, monkeypatch):
+    path = tmp_path / "cache"
+    monkeypatch.setattr(extract_pdf, "CACHE_DIR", str(path))
+    return path
+
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    path = tmp_path / "sample.pdf"
+    path.write_bytes(b"%PDF-1.4 not a real document")
+    return str(path)
+
+
+@pytest.fixture
+def stub_extractor(extract_pdf):
+    class StubExtractor(extract_pdf.PDFExtractor):
+        # Any installed distribution works; only its version ends up in the cache key.
+        library = "pytest"
+        pages = ["first page", "", "ページ3"]
+        calls = 0
+
+        def extract_pages(self):
+            type(self).calls += 1
+            return list(self.pages)
+
+    return StubExtractor
+
+
+def test_extract_text_caches_pages_and_reports_cache_hits(stub_extractor, cache_dir, pdf_path, tmp_path):
+    output_dir = str(tmp_path / "out")
+
+    first = stub_extractor(pdf_path, output_dir)
+    sections, _ = first.extract_text()
+    assert sections == stub_extractor.pages
+    assert first.from_cache is False
+
+    second = stub_extractor(pdf_path, output_dir)
+    sections, _ = second.extract_text()
+    assert sections == stub_extractor.pages
+    assert second.from_cache is True
+    assert stub_extractor.calls == 1
+
+    saved = tmp_path / "out" / "sample" / "3" / "section_3_StubExtractor.txt"
+    assert saved.read_text(encoding="utf-8") == "ページ3"
+
+
+def test_extract_text_without_cache_always_extracts(stub_extractor, cache_dir, pdf_path, tmp_path):
+    for _ in range(2):
+        extractor = stub_extractor(pdf_path, str(tmp_path / "out"), use_cache=False)
+        sections, _ = extractor.extract_text()
+        assert sections == stub_extractor.pages
+        assert extractor.from_cache is False
+
+    assert stub_extractor.calls == 2
+    assert not cache_dir.exists()
+
+
+def test_cache_key_includes_library_version(extract_pdf, stub_extractor, cache_dir, pdf_path, tmp_path, monkeypatch):
+    extractor = stub_extractor(pdf_path, str(tmp_path / "out"))
+    assert extractor.cache_key == f"StubExtractor_{metadata.version('pytest')}"
+
+    extractor.extract_text()
+    monkeypatch.setattr(extract_pdf.metadata, "version", lambda name: "999.0")
+    upgraded = stub_extractor(pdf_path, str(tmp_path / "out"))
+    upgraded.extract_text()
+
+    assert upgraded.from_cache is False
+    assert stub_extractor.calls == 2
+
+
+def test_incomplete_cache_is_ignored(stub_extractor, cache_dir, pdf_path, tmp_path):
+    extractor = stub_extractor(pdf_path, str(tmp_path / "out"))
+    cache_path = tmp_path / "partial"
+    extractor.cache_sections(str(cache_path), ["a", "b"])
+    assert extractor.load_cached_sections(str(cache_path)) == ["a", "b"]
+
+    os.remove(cache_path / "page_count")
+    assert extractor.load_cached_sections(str(cache_path)) is None
+
+    extractor.cache_sections(str(cache_path), ["a", "b"])
+    os.remove(cache_path / "2.txt")
+    assert extractor.load_cached_sections(str(cache_path)) is None
+
+
+def raise_exdev(src, dst):
+    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV), src, dst)
+
+
+def test_fast_move_copies_across_devices(extract_pdf, tmp_path, monkeypatch):
+    src = tmp_path / "page.png"
+    src.write_bytes(b"png bytes")
+    dst = tmp_path / "out.png"
+    dst.write_bytes(b"stale")
+    monkeypatch.setattr(extract_pdf.os, "replace", raise_exdev)
+
+    extract_pdf._fast_move(str(src), str(dst))
+
+    assert dst.read_bytes() == b"png bytes"
+    assert not src.exists()
+
+
+def test_fast_move_replaces_existing_destination(extract_pdf, tmp_path):
+    src = tmp_path / "page.png"
+    src.write_bytes(b"png bytes")
+    dst = tmp_path / "out.png"
+    dst.write_bytes(b"stale")
+
+    extract_pdf._fast_move(str(src), str(dst))
+
+    assert dst.read_bytes() == b"png bytes"
+    assert not src.exists()
+
+
+def test_fast_move_reraises_other_errors(extract_pdf, tmp_path, monkeypatch):
+    src = tmp_path / "page.png"
+    src.write_bytes(b"png bytes")
+
+    def raise_eacces(src, dst):
+        raise OSError(errno.EACCES, os.strerror(errno.EACCES), src, dst)
+
+    monkeypatch.setattr(extract_pdf.os, "replace", raise_eacces)
+
+    with pytest.raises(OSError) as excinfo:
+        extract_pdf._fast_move(str(src), str(tmp_path / "out.png"))
+
+    assert excinfo.value.errno == errno.EACCES
+    assert src.exists()
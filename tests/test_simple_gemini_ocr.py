@@ -0,0 +1,58 @@
+import importlib.util
+import os
+
+import pytest
+
+pytest.importorskip("google.generativeai")
+pytest.importorskip("dotenv")
+
+from google.ai import generativelanguage as glm  # noqa: E402
+from google.generativeai.types.generation_types import GenerateContentResponse  # noqa: E402
+
+MODULE_PATH = os.path.join(os.path.dirname(__file__), os.pardir, "src", "multimodal-rag", "samples", "simple_gemini_ocr.py")
+
+
+@pytest.fixture(scope="module")
+def ocr():
+    spec = importlib.util.spec_from_file_location("simple_gemini_ocr", MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_chunk(*texts, finish_reason=glm.Candidate.FinishReason.FINISH_REASON_UNSPECIFIED):
+    content = glm.Content(role="model", parts=[glm.Part(text=text) for text in texts])
+    return glm.GenerateContentResponse(candidates=[glm.Candidate(content=content, finish_reason=finish_reason)])
+
+
+def make_stream(*chunks):
+    return GenerateContentResponse.from_iterator(iter(chunks))
+
+
+def test_stream_markdown_writes_chunks_in_order(ocr, tmp_path):
+    file_path = str(tmp_path / "section_1_PyPDF2Extractor.txt")
+    response = make_stream(make_chunk("# Title\n"), make_chunk("body", " text"), make_chunk("\n", finish_reason=glm.Candidate.FinishReason.STOP))
+
+    ocr.stream_markdown(file_path, response)
+
+    assert (tmp_path / "section_1_PyPDF2Extractor.md").read_text(encoding="utf-8") == "# Title\nbody text\n"
+
+
+@pytest.mark.parametrize("finish_reason", [glm.Candidate.FinishReason.MAX_TOKENS, glm.Candidate.FinishReason.SAFETY])
+def test_stream_markdown_skips_final_chunk_without_parts(ocr, tmp_path, finish_reason):
+    file_path = str(tmp_path / "section_1_PyPDF2Extractor.txt")
+    final_chunk = make_chunk(finish_reason=finish_reason)
+    response = make_stream(make_chunk("# Title\n"), final_chunk)
+
+    ocr.stream_markdown(file_path, response)
+
+    assert (tmp_path / "section_1_PyPDF2Extractor.md").read_text(encoding="utf-8") == "# Title\n"
+
+
+def test_stream_markdown_skips_chunk_without_candidates(ocr, tmp_path):
+    file_path = str(tmp_path / "section_1_PyPDF2Extractor.txt")
+    response = make_stream(make_chunk("# Title\n"), glm.GenerateContentResponse())
+
+    ocr.stream_markdown(file_path, response)
+
+    assert (tmp_path / "section_1_PyPDF2Extractor.md").read_text(encoding="utf-8") == "# Title\n"